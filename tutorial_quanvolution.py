@@ -75,15 +75,18 @@ generate highly complex kernels whose computation could be, at least in principl
 
 General setup
 -------------
-This Python code requires *PennyLane* with the *TensorFlow* interface and the plotting library *matplotlib*.
+This Python code requires *PennyLane* with the *TensorFlow* interface, the plotting library *matplotlib*
+and the JIT compiler *Numba*.
+The optional JAX-compiled pre-processing additionally requires *JAX*.
 """
 
 import pennylane as qml
-from pennylane import numpy as np
+import numpy as np
 from pennylane.templates import RandomLayers
 import tensorflow as tf
 from tensorflow import keras
 import matplotlib.pyplot as plt
+from numba import njit, prange
 
 ##############################################################################
 # Setting of the main hyper-parameters of the model
@@ -102,6 +105,7 @@ import os
 os.makedirs(SAVE_PATH, exist_ok=True)
 
 PREPROCESS = True           # If False, skip quantum processing and load data from SAVE_PATH
+USE_JAX = False             # If True, pre-process the images with a JIT-compiled JAX version of the circuit
 np.random.seed(0)           # Seed for NumPy random number generator
 tf.random.set_seed(0)       # Seed for TensorFlow random number generator
 
@@ -121,13 +125,17 @@ train_labels = train_labels[:n_train]
 test_images = test_images[:n_test]
 test_labels = test_labels[:n_test]
 
+# Keep the raw 8-bit pixel values for the quantum pre-processing
+train_pixels = train_images[..., tf.newaxis]
+test_pixels = test_images[..., tf.newaxis]
+
 # Normalize pixel values within 0 and 1
 train_images = train_images / 255
 test_images = test_images / 255
 
 # Add extra dimension for convolution channels
-train_images = np.array(train_images[..., tf.newaxis], requires_grad=False)
-test_images = np.array(test_images[..., tf.newaxis], requires_grad=False)
+train_images = train_images[..., tf.newaxis]
+test_images = test_images[..., tf.newaxis]
 
 
 ##############################################################################
@@ -137,7 +145,7 @@ test_images = np.array(test_images[..., tf.newaxis], requires_grad=False)
 # We follow the scheme described in the introduction and represented in the figure at the top
 # of this demo.
 #
-# We initialize a PennyLane ``default.qubit`` device, simulating a system of :math:`4` qubits.
+# We initialize a PennyLane ``lightning.qubit`` device, a C++ simulator of a system of :math:`4` qubits.
 # The associated ``qnode`` represents the quantum circuit consisting of:
 #
 # 1. an embedding layer of local :math:`R_y` rotations (with angles scaled by a factor of :math:`\pi`);
@@ -145,31 +153,125 @@ test_images = np.array(test_images[..., tf.newaxis], requires_grad=False)
 # 2. a random circuit of ``n_layers``;
 #
 # 3. a final measurement in the computational basis, estimating :math:`4` expectation values.
+#
+# This ``qnode`` is kept as the reference definition of the quantum kernel. The default
+# pre-processing below never executes it, but evaluates the same circuit with a precomputed
+# unitary, so the choice of device does not affect its speed.
 
 
-dev = qml.device("default.qubit", wires=4)
+dev = qml.device("lightning.qubit", wires=4)
 # Random circuit parameters
 rand_params = np.random.uniform(high=2 * np.pi, size=(n_layers, 4))
+# Since the parameters are fixed, the random layers are expanded into elementary gates only once.
+# This only saves work when the qnode itself is executed (e.g. by the JAX path), not in the
+# default pre-processing, which uses the precomputed unitary instead.
+random_ops = RandomLayers(rand_params, wires=list(range(4))).decomposition()
 
 @qml.qnode(dev)
 def circuit(phi):
-    # Encoding of 4 classical input values
+    # Encoding of 4 classical input values (``phi`` may carry a leading batch dimension)
     for j in range(4):
-        qml.RY(np.pi * phi[j], wires=j)
+        qml.RY(np.pi * phi[..., j], wires=j)
 
     # Random quantum circuit
-    RandomLayers(rand_params, wires=list(range(4)))
+    for op in random_ops:
+        qml.apply(op)
 
     # Measurement producing 4 classical output values
     return [qml.expval(qml.PauliZ(j)) for j in range(4)]
 
 
 ##############################################################################
-# The next function defines the convolution scheme:
+# Since the parameters of the random circuit are fixed, the whole random layer is a constant
+# :math:`16 \times 16` unitary matrix :math:`U.` We can compute it once with ``qml.matrix``
+# and then simulate the circuit directly with NumPy: the :math:`R_y` embedding prepares the
+# product state
+#
+# .. math::
+#
+#     |\psi\rangle = \bigotimes_{j=0}^{3} \left( \cos(\pi \phi_j / 2) |0\rangle + \sin(\pi \phi_j / 2) |1\rangle \right),
+#
+# which is multiplied by :math:`U,` and each expectation value is obtained by weighting the
+# probabilities of the basis states with the diagonal of the corresponding :math:`Z_j`
+# observable. This simulation is compiled with *Numba* into a kernel which processes a whole
+# batch of inputs in parallel, writing the results directly into an output buffer.
+
+# The unitary only depends on the random parameters, hence it is saved in SAVE_PATH together
+# with them and only recomputed when the parameters change
+U = None
+if os.path.exists(SAVE_PATH + "random_unitary.npz"):
+    with np.load(SAVE_PATH + "random_unitary.npz") as saved_unitary:
+        if np.array_equal(saved_unitary["rand_params"], rand_params):
+            U = saved_unitary["U"]
+
+if U is None:
+    U = qml.matrix(RandomLayers(rand_params, wires=list(range(4))), wire_order=range(4))
+    np.savez(SAVE_PATH + "random_unitary.npz", U=U, rand_params=rand_params)
+
+# Single precision is more than enough for a 4-qubit simulation with 8-bit inputs
+U = U.astype(np.complex64)
+
+# Diagonals of the 4 Pauli-Z observables in the computational basis (wire 0 is the most significant bit)
+Z_diags = (1 - 2 * ((np.arange(16) >> (3 - np.arange(4)[:, None])) & 1)).astype(np.float32)
+
+# Since the input pixels can only take 256 values, the amplitudes cos(pi * phi / 2) and
+# sin(pi * phi / 2) of the embedding are tabulated once for every 8-bit pixel value
+RY_LUT = np.stack(
+    [np.cos(np.pi * np.arange(256) / 255 / 2), np.sin(np.pi * np.arange(256) / 255 / 2)], axis=1
+).astype(np.float32)
+
+# Black squares, which make up most of the borders of MNIST images, leave the qubits in the
+# ground state, hence their expectation values are simply given by the first column of U
+ZERO_RESULT = (np.abs(U[:, 0]) ** 2) @ Z_diags.T
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def quanv_kernel(pixels, U, Z_diags, ry_lut, zero_result, out):
+    """Simulates ``circuit`` with the precomputed unitary for each column of a (4, batch) array of
+    8-bit pixels, writing the 4 expectation values into the corresponding row of ``out``."""
+    if out.shape[0] != pixels.shape[1]:
+        raise ValueError("out must have one row per column of pixels")
+
+    for p in prange(pixels.shape[1]):
+        # Black squares do not need to be simulated
+        if pixels[0, p] == 0 and pixels[1, p] == 0 and pixels[2, p] == 0 and pixels[3, p] == 0:
+            out[p, :] = zero_result
+            continue
+
+        # Product state prepared by the R_y embedding
+        psi = np.ones(16, dtype=np.float32)
+        for j in range(4):
+            c = ry_lut[pixels[j, p], 0]
+            s = ry_lut[pixels[j, p], 1]
+            for i in range(16):
+                psi[i] *= s if (i >> (3 - j)) & 1 else c
+
+        # Expectation values of the Z_j observables on the state U |psi>, accumulated locally
+        # so that each output channel is stored only once
+        z0 = z1 = z2 = z3 = np.float32(0)
+        for r in range(16):
+            amp = np.complex64(0)
+            for i in range(16):
+                amp += U[r, i] * psi[i]
+            prob = amp.real * amp.real + amp.imag * amp.imag
+            z0 += Z_diags[0, r] * prob
+            z1 += Z_diags[1, r] * prob
+            z2 += Z_diags[2, r] * prob
+            z3 += Z_diags[3, r] * prob
+        out[p, 0] = z0
+        out[p, 1] = z1
+        out[p, 2] = z2
+        out[p, 3] = z3
+
+
+##############################################################################
+# The next functions define the convolution scheme:
 #
 # 1. the image is divided into squares of :math:`2 \times 2` pixels;
 #
-# 2. each square is processed by the quantum circuit;
+# 2. each square is processed by the quantum circuit. Rather than simulating the
+#    circuit once per square, all the squares are stacked along a batch dimension
+#    and evaluated at once by ``quanv_kernel``;
 #
 # 3. the :math:`4` expectation values are mapped into :math:`4` different
 #    channels of a single output pixel.
@@ -180,28 +282,80 @@ def circuit(phi):
 #       with a :math:`2 \times 2` *kernel* and a *stride* equal to :math:`2.`
 
 
-def quanv(image):
-    """Convolves the input image with many applications of the same quantum circuit."""
-    out = np.zeros((14, 14, 4))
-
-    # Loop over the coordinates of the top-left pixel of 2X2 squares
-    for j in range(0, 28, 2):
-        for k in range(0, 28, 2):
-            # Process a squared 2x2 region of the image with a quantum circuit
-            q_results = circuit(
-                [
-                    image[j, k, 0],
-                    image[j, k + 1, 0],
-                    image[j + 1, k, 0],
-                    image[j + 1, k + 1, 0]
-                ]
-            )
-            # Assign expectation values to different channels of the output pixel (j/2, k/2)
-            for c in range(4):
-                out[j // 2, k // 2, c] = q_results[c]
+def quanv_dataset(images, out=None):
+    """Convolves a batch of images, given as raw 8-bit pixels, with many applications
+    of the same quantum circuit. The results are written into ``out`` if provided."""
+    images = np.asarray(images)
+    if images.dtype != np.uint8:
+        raise ValueError(
+            "images must be given as raw 8-bit pixels (dtype uint8), not {}".format(images.dtype)
+        )
+
+    # Each output pixel corresponds to a 2x2 square, hence an odd last row or column is dropped
+    n_rows, n_cols = images.shape[1] // 2, images.shape[2] // 2
+    images = images[:, : 2 * n_rows, : 2 * n_cols]
+    if out is None:
+        out = np.empty((len(images), n_rows, n_cols, 4), dtype=np.float32)
+    elif out.shape != (len(images), n_rows, n_cols, 4) or not out.flags.c_contiguous:
+        raise ValueError(
+            "out must be a C-contiguous array of shape {}".format((len(images), n_rows, n_cols, 4))
+        )
+
+    # Gather the squared 2x2 regions of all the images with strided views, storing each of the
+    # 4 pixels of the regions as a contiguous plane of a (4, n_rows * n_cols * n_images) array
+    patches = np.stack(
+        [
+            images[:, 0::2, 0::2, 0],
+            images[:, 0::2, 1::2, 0],
+            images[:, 1::2, 0::2, 0],
+            images[:, 1::2, 1::2, 0]
+        ]
+    ).reshape(4, -1)
+
+    # Process all the regions at once and assign the expectation values to the output channels
+    quanv_kernel(patches, U, Z_diags, RY_LUT, ZERO_RESULT, out.reshape(-1, 4))
     return out
 
 
+def quanv(image):
+    """Convolves the input image, given as raw 8-bit pixels, with many applications
+    of the same quantum circuit."""
+    return quanv_dataset(np.asarray(image)[np.newaxis])[0]
+
+
+##############################################################################
+# Optionally, the same convolution can be compiled with *JAX*. The quantum circuit is
+# re-wrapped as a QNode with the JAX interface and mapped with ``jax.vmap`` over
+# the patches of every image and over all the images of the dataset, so that the full
+# pre-processing becomes a single XLA computation compiled by ``jax.jit``.
+# This requires the *JAX* library and is enabled by setting ``USE_JAX = True``.
+
+if USE_JAX:
+    import jax
+    import jax.numpy as jnp
+
+    # The JAX-native simulator is used, since it can be traced and mapped by JAX
+    jax_circuit = qml.qnode(qml.device("default.qubit", wires=4), interface="jax")(circuit.func)
+
+    @jax.jit
+    def quanv_jax(images):
+        """Convolves a batch of images, given as raw 8-bit pixels, with the quantum circuit
+        as one compiled computation."""
+        images = images / 255
+        patches = jnp.stack(
+            [
+                images[:, 0::2, 0::2, 0],
+                images[:, 0::2, 1::2, 0],
+                images[:, 1::2, 0::2, 0],
+                images[:, 1::2, 1::2, 0]
+            ],
+            axis=-1,
+        )
+        # Map the circuit over the images, the rows and the columns of 2x2 squares
+        q_results = jax.vmap(jax.vmap(jax.vmap(jax_circuit)))(patches)
+        return jnp.stack(q_results, axis=-1)
+
+
 ##############################################################################
 # Quantum pre-processing of the dataset
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
@@ -211,28 +365,37 @@ def quanv(image):
 # Later an entirely classical model will be directly trained and tested on the
 # pre-processed dataset, avoiding unnecessary repetitions of quantum computations.
 #
-# The pre-processed images will be saved in the folder ``SAVE_PATH``.
+# The pre-processed images will be saved in the folder ``SAVE_PATH``. To avoid keeping
+# a second copy of the dataset in memory, they are written directly into the files.
 # Once saved, they can be directly loaded by setting ``PREPROCESS = False``,
 # otherwise the quantum convolution is evaluated at each run of the code.
+#
+# Rather than convolving the images one by one, ``quanv_dataset`` gathers the
+# squared regions of the whole dataset and processes all of them with a single
+# call of the kernel, which distributes them over all the available CPU cores.
 
 if PREPROCESS == True:
-    q_train_images = []
-    print("Quantum pre-processing of train images:")
-    for idx, img in enumerate(train_images):
-        print("{}/{}        ".format(idx + 1, n_train), end="\r")
-        q_train_images.append(quanv(img))
-    q_train_images = np.asarray(q_train_images)
-
-    q_test_images = []
-    print("\nQuantum pre-processing of test images:")
-    for idx, img in enumerate(test_images):
-        print("{}/{}        ".format(idx + 1, n_test), end="\r")
-        q_test_images.append(quanv(img))
-    q_test_images = np.asarray(q_test_images)
-
-    # Save pre-processed images
-    np.save(SAVE_PATH + "q_train_images.npy", q_train_images)
-    np.save(SAVE_PATH + "q_test_images.npy", q_test_images)
+    if USE_JAX:
+        print("Quantum pre-processing of train and test images with JAX")
+        q_train_images = np.asarray(quanv_jax(jnp.asarray(train_pixels)), dtype=np.float32)
+        q_test_images = np.asarray(quanv_jax(jnp.asarray(test_pixels)), dtype=np.float32)
+
+        # Save pre-processed images
+        np.save(SAVE_PATH + "q_train_images.npy", q_train_images)
+        np.save(SAVE_PATH + "q_test_images.npy", q_test_images)
+    else:
+        print("Quantum pre-processing of train and test images")
+        # The pre-processed images are written directly into memory-mapped .npy files
+        q_train_images = np.lib.format.open_memmap(
+            SAVE_PATH + "q_train_images.npy", mode="w+", dtype=np.float32, shape=(n_train, 14, 14, 4)
+        )
+        q_test_images = np.lib.format.open_memmap(
+            SAVE_PATH + "q_test_images.npy", mode="w+", dtype=np.float32, shape=(n_test, 14, 14, 4)
+        )
+        quanv_dataset(train_pixels, out=q_train_images)
+        quanv_dataset(test_pixels, out=q_test_images)
+        q_train_images.flush()
+        q_test_images.flush()
 
 
 # Load pre-processed images
@@ -302,6 +465,20 @@ def MyModel():
     return model
 
 
+##############################################################################
+# The training and validation samples are fed to the model through a *tf.data* input
+# pipeline, which caches the samples after the first epoch and prepares the next batches
+# while the current one is being processed.
+
+
+def make_dataset(images, labels, shuffle=False):
+    """Returns a cached and prefetched ``tf.data.Dataset`` of batches of 4 samples."""
+    dataset = tf.data.Dataset.from_tensor_slices((images, labels)).cache()
+    if shuffle:
+        dataset = dataset.shuffle(len(images))
+    return dataset.batch(4).prefetch(tf.data.AUTOTUNE)
+
+
 ##############################################################################
 # Training
 # ^^^^^^^^
@@ -312,10 +489,8 @@ def MyModel():
 q_model = MyModel()
 
 q_history = q_model.fit(
-    q_train_images,
-    train_labels,
-    validation_data=(q_test_images, test_labels),
-    batch_size=4,
+    make_dataset(q_train_images, train_labels, shuffle=True),
+    validation_data=make_dataset(q_test_images, test_labels),
     epochs=n_epochs,
     verbose=2,
 )
@@ -328,10 +503,8 @@ q_history = q_model.fit(
 c_model = MyModel()
 
 c_history = c_model.fit(
-    train_images,
-    train_labels,
-    validation_data=(test_images, test_labels),
-    batch_size=4,
+    make_dataset(train_images, train_labels, shuffle=True),
+    validation_data=make_dataset(test_images, test_labels),
     epochs=n_epochs,
     verbose=2,
 )